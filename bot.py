@@ -1,125 +1,192 @@
 import asyncio # asynchronous funcionality
 import discord # basic discord functions
 from discord.ext import commands # discord bot functions
-import mysql.connector as mysql # mysql functions
-import time # for time purposes
-from apscheduler.schedulers.asyncio import AsyncIOScheduler # async scheduler
-from apscheduler.triggers.cron import CronTrigger # timed trigger
-import yaml, os, subprocess
+import yaml, os, subprocess, functools, logging
+try: # libyaml's C loader, if yaml was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+log = logging.getLogger("questbored")
+
+file_dir = os.path.dirname(os.path.abspath(__file__)) # get abs location of file
+conf_path = os.path.join(file_dir, 'conf.yaml')
+
+@functools.lru_cache(maxsize=1)
+def _load_conf(mtime: float) -> dict:
+    with open(conf_path, 'r') as file:
+        return yaml.load(file, Loader=SafeLoader)
+
+def load_conf() -> dict: # only re-parsed when conf.yaml changes
+    return _load_conf(os.path.getmtime(conf_path))
+
+# available extensions, rescanned on startup, update & refresh
+available_exts: set[str] = set()
+# active extensions, kept in step by main, load & unload
+active_exts: set[str] = set()
+
+def rescan_extensions():
+    global available_exts
+    with os.scandir(file_dir) as entries:
+        available_exts = {e.name.removesuffix("_extension.py") for e in entries if e.name.endswith("_extension.py") and e.is_file()}
+
+def ext_key(name: str) -> str: # module name of an extension
+    return name+"_extension"
+
+class questbored_bot(commands.Bot):
+    """A bot that caps how many commands are handled at the same time"""
+
+    def __init__(self, *args, max_concurrent_commands: int = 64, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.command_slots = asyncio.Semaphore(max_concurrent_commands)
+
+    async def invoke(self, ctx: commands.Context):
+        # wrapping invoke (rather than before/after hooks) releases the slot
+        # exactly once, even for groups and failing commands
+        async with self.command_slots:
+            await super().invoke(ctx)
+
+    # event listeners
+    async def on_ready(self):
+        log.info("===\n"\
+                f"Logged in as {self.user}\n"
+                f" - prefix '{self.command_prefix}'\n"\
+                f" - ping {self.latency * 1000} ms\n"\
+                 "===")
 
-file_dir = '/'.join(__file__.split('/')[:-1]) # get abs location of file
-with open(file_dir+'/conf.yaml', 'r') as file:
-    conf: dict = yaml.safe_load(file)
+# extension management    
+async def extension_operation(ctx: commands.Context, ext: str, key: str, verb: str, operation) -> bool:
+    """Runs a (re/un)load operation on an extension's module key, reporting the outcome in discord"""
+    m = await ctx.send(f"{verb.capitalize()}ing `{ext}` ...")
+    log.info(f"{verb.capitalize()}ing `{ext}` extension")
+    try:
+        operation(key)
+    except Exception as e:
+        await m.edit(f"Something went wrong when {verb}ing `{ext}`\n```\n{e}```")
+        return False
 
-# main & startup function
-print(" - building bot")
-intents = discord.Intents.default()
-intents.message_content = True
-QuestBored = commands.Bot(command_prefix=conf['prefix'], intents=intents)
-
-print(" - loading extensions")
-for extension in conf["extensions"]:
-    QuestBored.load_extension(extension+"_extension")
-
-# event listeners
-@QuestBored.event
-async def on_ready():
-    print( "===\n"\
-          f"Logged in as {QuestBored.user}\n"
-          f" - prefix '{QuestBored.command_prefix}'\n"\
-          f" - ping {QuestBored.latency * 1000} ms\n"\
-           "===")
+    await m.edit(f"Successfully {verb}ed `{ext}`")
+    return True
 
-# extension management    
-@QuestBored.group(
+@commands.group(
     invoke_without_command=True
 )
 async def extensions(ctx: commands.Context):
-    available = set([f.removesuffix("_extension.py") for f in os.listdir(file_dir) if f.endswith("_extension.py")])
-    active = set([e.removesuffix("_extension") for e in QuestBored.extensions])
-    unused = available.difference(active)
-
-    if len(unused) == 0: unused = ('-')
-    if len(active) == 0: active = ('-')
+    active = active_exts if active_exts else ('-')
+    unused = available_exts - active_exts
+    if not unused: unused = ('-')
 
     await ctx.send(f"### Active extensions:\n{', '.join(active)}\n### Available extensions:\n{', '.join(unused)}")
 
 @extensions.command(
 
 )
+@commands.cooldown(1, 5, commands.BucketType.channel) # stay clear of discord's per channel rate limit
 async def reload(ctx: commands.Context, ext: str = None):
-    if not ext or ext+"_extension" not in QuestBored.extensions:
+    key = ext_key(ext) if ext else None
+    if not key or key not in ctx.bot.extensions:
         raise Exception(f"`{ext}` is not a currently loaded extension.")
     
-    m = await ctx.send(f"Reloading `{ext}` ...")
-    print(f"Reloading `{ext}` extension")
-    try:
-        QuestBored.reload_extension(ext+"_extension")
-        await m.edit(f"Successfully reloaded `{ext}`")
-    except Exception as e:
-        await m.edit(f"Something went wrong when reloading `{ext}`\n```\n{e}```")
+    await extension_operation(ctx, ext, key, "reload", ctx.bot.reload_extension)
 
 @extensions.command(
 
 )
+@commands.cooldown(1, 5, commands.BucketType.channel) # stay clear of discord's per channel rate limit
 async def load(ctx: commands.Context, ext: str = None):
-    if not ext or ext not in [f.removesuffix("_extension.py") for f in os.listdir(file_dir) if f.endswith("_extension.py")]:
+    if not ext or ext not in available_exts:
         raise Exception(f"`{ext}` is not an available extension.")
-    elif ext+"_extension" in QuestBored.extensions:
+    key = ext_key(ext)
+    if key in ctx.bot.extensions:
         raise Exception(f"`{ext}` is already loaded.") 
     
-    m = await ctx.send(f"Loading `{ext}` ...")
-    print(f"Loading `{ext}` extension")
-    try:
-        QuestBored.load_extension(ext+"_extension")
-        await m.edit(f"Successfully loaded `{ext}`")
-    except Exception as e:
-        await m.edit(f"Something went wrong when loading `{ext}`\n```\n{e}```")
+    if await extension_operation(ctx, ext, key, "load", ctx.bot.load_extension):
+        active_exts.add(ext)
 
 @extensions.command(
 
 )
+@commands.cooldown(1, 5, commands.BucketType.channel) # stay clear of discord's per channel rate limit
 async def unload(ctx: commands.Context, ext: str = None):
-    if not ext or ext+"_extension" not in QuestBored.extensions:
+    key = ext_key(ext) if ext else None
+    if not key or key not in ctx.bot.extensions:
         raise Exception(f"`{ext}` is not an active extension.")
     
-    m = await ctx.send(f"Unloading `{ext}` ...")
-    print(f"Unloading `{ext}` extension")
-    try:
-        QuestBored.unload_extension(ext+"_extension")
-        await m.edit(f"Successfully unloaded `{ext}`")
-    except Exception as e:
-        await m.edit(f"Something went wrong when unloading `{ext}`\n```\n{e}```")
+    if await extension_operation(ctx, ext, key, "unload", ctx.bot.unload_extension):
+        active_exts.discard(ext)
 
 @extensions.command(
 
 )
+async def refresh(ctx: commands.Context):
+    rescan_extensions()
+    await ctx.send(f"Found {len(available_exts)} available extensions")
+
+@extensions.command(
+
+)
+@commands.cooldown(1, 5, commands.BucketType.channel) # stay clear of discord's per channel rate limit
 async def update(ctx: commands.Context):
     m = await ctx.send("Updating code ...")
     try:
-        print("Updating code via subprocess 'git pull'")
-        out = subprocess.run(cwd = file_dir,
-                             args = ["git","pull"],
-                             capture_output = True,
-                             check = True,
-                             text = True)
-        
-        for l in out.stdout.split("\n"):
-            print("> "+l)
+        log.info("Updating code via subprocess 'git pull'")
+        proc = await asyncio.create_subprocess_exec("git", "pull",
+                                                    cwd = file_dir,
+                                                    stdout = asyncio.subprocess.PIPE,
+                                                    stderr = asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate() # don't block the event loop while pulling
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, ["git","pull"], stdout, stderr)
+
+        for l in stdout.decode().split("\n"):
+            log.info("> "+l)
         
-        await m.edit("Code updated")
+        rescan_extensions()
     except Exception as e:
         await m.edit(f"Something went wrong when running `git pull` to update the code\n```\n{e}```")
         return
-    
-    m = await ctx.send("Reloading extensions ...")
-    print("Reloading extensions")
-    for ext in [e for e in QuestBored.extensions]:
+
+    # reloading doesn't yield to the event loop, so a progress edit here would
+    # be overwritten right away - report both stages in the final edit instead
+    log.info("Reloading extensions")
+    failed = {}
+    for ext in [e for e in ctx.bot.extensions]:
         try:
-            QuestBored.reload_extension(ext)
-        except Exception as e:
-            await m.edit(f"Something went wrong when reloading `{ext}`\n```\n{e}```")
-            return
-    await m.edit("Successfully reloaded all extensions")
+            ctx.bot.reload_extension(ext)
+        except Exception as e: # keep going, report every failure at the end
+            failed[ext] = e
+
+    if failed:
+        await m.edit("Code updated\n" + "\n".join([f"Something went wrong when reloading `{ext}`\n```\n{e}```" for ext, e in failed.items()]))
+    else:
+        await m.edit("Code updated\nSuccessfully reloaded all extensions")
 
-QuestBored.run(conf['token'])
\ No newline at end of file
+# main & startup function
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    conf = load_conf()
+    rescan_extensions()
+
+    # use libuv's event loop where available, before the bot grabs a loop
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError: # windows / not installed, keep the default loop
+        pass
+
+    log.info(" - building bot")
+    intents = discord.Intents.default()
+    intents.message_content = True
+    QuestBored = questbored_bot(command_prefix=conf['prefix'],
+                                intents=intents,
+                                max_concurrent_commands=conf.get('max_concurrent_commands', 64))
+    QuestBored.add_command(extensions)
+
+    log.info(" - loading extensions")
+    QuestBored.load_extensions(*[ext_key(extension) for extension in conf["extensions"]])
+    active_exts.update({e.removesuffix("_extension") for e in QuestBored.extensions})
+
+    QuestBored.run(conf['token'])
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,7 +1,12 @@
+import re
+
 lines_to_ignore=(">","> ","- ","-")
 chars_to_ignore=("*","`","|",'"',"_")
 rp_indicators=('*','"','_')
 
+_ignore_table=str.maketrans({char: " " for char in chars_to_ignore}) # replaces ignored chars in one pass
+_word_pattern=re.compile("[^ ]+") # a word is anything between spaces
+
 def _find_substring_indexes(desired_substring, message, index_type='start'): # returns index/es of substring
     array_of_indexes=[]
     # start the search at 0
@@ -118,16 +123,12 @@ def count(msg):
     valid_pairs=_remove_redundant_pairs(valid_pairs)
 
     # clean up characters which should not count as words
-    for char_to_rem in chars_to_ignore:
-        message = message.replace(char_to_rem, " ")
+    message = message.translate(_ignore_table)
 
     # Go through the valid segments of the original message and count the words inside them
     word_count=0
     for rp_pair in valid_pairs:
-        rp_text=message[rp_pair[0]+1:rp_pair[1]]
-        for word in rp_text.split(' '):
-            if word != '':
-                word_count+=1 # ignore empty words
+        word_count+=len(_word_pattern.findall(message, rp_pair[0]+1, rp_pair[1]))
 
     return word_count
 
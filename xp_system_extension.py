@@ -1,28 +1,32 @@
-import discord, asyncio, yaml, traceback, validators.url
+import discord, asyncio, yaml, traceback, validators.url, time, os
 from discord.ext import commands
 import aiomysql as mysql
+from pymysql.constants import CLIENT
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from rp_word_counter import count
 from datetime import datetime, timezone
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+try: # libyaml's C loader, if yaml was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 # extension functions
 def setup(bot):
     # load conf
-    with open('/'.join(__file__.split('/')[:-1])+'/conf.yaml', 'r') as file:
-        config = yaml.safe_load(file)["extensions"]["xp_system"]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf.yaml'), 'r') as file:
+        config = yaml.load(file, Loader=SafeLoader)["extensions"]["xp_system"]
 
     bot.add_cog(xp_system_db_connection(bot, config))
     db = bot.get_cog("xp_system_db_connection")
-    loop = asyncio.get_event_loop()
-    loop.create_task(db._build_pool()) # connect to db
-    loop.create_task(db._start_scheduler()) # start scheduler
+    db._startup_task = bot.loop.create_task(db._start()) # connect to db, then start the scheduler
 
     bot.add_cog(xp_system(bot, config))
 
 def clean_url(url):
-    if url[0] == "<" and url[-1] == ">": url = url[1:-1]
+    if url.startswith("<") and url.endswith(">"): url = url[1:-1] # discord's embed suppression
     parsed = urlparse(url)
     query = dict(parse_qsl(parsed.query))  # Parse and reformat query
     cleaned_query = urlencode(query)  # Re-encode query string
@@ -31,6 +35,8 @@ def clean_url(url):
 # Util classes
 class player_character():
     """A data class for handling character data stored in the database"""
+    __slots__ = ("id", "name", "color", "image_url", "total_xp", "roleplay_xp", "level",
+                 "level_notification", "words_cached", "owner_id", "pool_id", "active_on_account")
     id: int
     name: str
     color: hex
@@ -49,12 +55,41 @@ class player_character():
         self.roleplay_xp, self.level, self.level_notification, \
         self.words_cached, self.owner_id, self.pool_id, self.active_on_account = attributes
 
-        if type(self.color) == str: self.color = int(self.color, 16)
+        if isinstance(self.color, str): self.color = int(self.color, 16)
 
 class notifyUserException(Exception):
     """Raised to notify a member in discord when something goes wrong (like them inputting a wrong argument)"""
     pass
 
+class missingPermissionsException(commands.CheckFailure):
+    """Raised when a command needs more permissions than its extras list, and the member doesn't have them"""
+    def __init__(self, required_permissions: list[str]):
+        self.required_permissions = required_permissions
+        super().__init__()
+
+# embed descriptions for command errors, looked up along the error's mro
+command_error_descriptions = {
+    commands.CheckFailure: lambda ctx, error: "You're missing permissions to use that command.\n"\
+        f"You need the following permissions: `{', '.join(getattr(error, 'required_permissions', None) or ctx.command.extras.get('required_permissions', ()))}`",
+    commands.UserInputError: lambda ctx, error: "User input error",
+}
+
+# mysql client errors meaning the connection itself failed, the only ones worth retrying & rebuilding for:
+# can't connect, server gone away, lost connection during query, lost connection to server
+connection_error_codes = frozenset({2003, 2006, 2013, 2055})
+
+def _is_connection_error(error: Exception) -> bool:
+    if isinstance(error, mysql.InterfaceError): # e.g. using a connection that was already closed
+        return True
+    return bool(error.args) and error.args[0] in connection_error_codes
+
+# char edit flags and the character property each of them sets
+character_edit_flags = {
+    "-n": "character_name", "-name": "character_name",
+    "-c": "character_color", "-color": "character_color",
+    "-i": "character_image", "-image": "character_image",
+}
+
 # cogs
 class xp_system_db_connection(commands.Cog):
     """A cog that handles interacting with a MySQL database asynchronously with a pool of connections."""
@@ -67,62 +102,142 @@ class xp_system_db_connection(commands.Cog):
         self.crash_time: datetime = None
         self.waiting_executions = 0
         self.stagger_time = 0.25
+        self.max_stagger = 10.0 # cap on the staggered wait, however many executions piled up
         self.max_retries = 3
+        self.max_backoff = 30
+        self.rebuild_lock = asyncio.Lock()
+        self._startup_task: asyncio.Task = None # set by setup
+        self.scheduler: AsyncIOScheduler = None # only started once the pool is up
 
         # periodic reset
         if "periodic_cap" in configuration:
             self.reset_cron = configuration["periodic_cap"]["cron"]
             self.reset_tz = configuration["periodic_cap"]["timezone"]
 
+        # buffered xp gains from roleplay messages, written in batches
+        self.pending_xp: dict[int, dict] = {}
+        self.flush_interval: float = configuration.get("xp_flush", {}).get("interval", 2)
+        self.flush_max_rows: int = configuration.get("xp_flush", {}).get("max_rows", 50)
+        self._flush_task: asyncio.Task = None # flush started by a full buffer, at most one at a time
+        self._flushing_xp: list[dict[int, dict]] = [] # batches being written, not yet visible in reads
+
+        # active characters per account, cached as (character, expiry) to skip lookups on every message
+        self.active_character_cache: dict[int, tuple[player_character, float]] = {}
+        self.active_character_ttl: float = 30
+
+        # leaderboard rows per limit, cached as (rows, expiry) so spamming top doesn't hit the db
+        self.top_cache: dict[int, tuple[list[tuple], float]] = {}
+        self.top_cache_ttl: float = 30
+        self.leaderboard_columns = frozenset({"total_xp", "character_name", "owner_id"}) # writes to these clear top_cache
+
+        # pool of each account, only changed by merge_pools & separate_pools, which clear it
+        self.pool_cache: dict[int, int] = {}
+
         # db info
         self.credentials: dict = configuration["database"]["credentials"]
+        # lets commit send all of its statements in a single round trip
+        self.credentials["client_flag"] = self.credentials.get("client_flag", 0) | CLIENT.MULTI_STATEMENTS
         self.max_characters_per_pool: int = configuration["max_characters_per_pool"]
         self.char_table: str = configuration["database"]["char_table"]
         self.acc_table: str  = configuration["database"]["acc_table"]
-        self.min_level: int  = list(configuration["level_req"].keys())[0]
-        self.max_level: int  = list(configuration["level_req"].keys())[-1]
+        self.min_level: int  = min(configuration["level_req"]) # don't rely on the order levels are listed in
+        self.max_level: int  = max(configuration["level_req"])
 
-    def cog_unload(self): # make sure to close the connection
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._close_pool())
+    def cog_unload(self): # make sure to write buffered xp & close the connection
+        if self._startup_task: # may still be waiting for the db, don't let it start jobs for an unloaded cog
+            self._startup_task.cancel()
+        self.bot.loop.create_task(self._flush_and_close_pool())
         
-        self.scheduler.shutdown(wait=False)
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
 
         return super().cog_unload()
     
+    async def _start(self):
+        await self._build_pool()
+        if not self.stable_pool.is_set(): # db wasn't reachable yet, retry until it is
+            await self._rebuild_pool()
+        await self._ensure_indexes()
+        await self._start_scheduler()
+
+    async def _ensure_indexes(self):
+        """Adds the indexes the bot's lookups rely on, if the tables don't have them yet"""
+        wanted = {
+            self.char_table: {"idx_pool_name": "pool_id, character_name",
+                              "idx_owner_active": "owner_id, active_on_account",
+                              "idx_active": "active_on_account",
+                              "idx_total_xp": "total_xp DESC"},
+            self.acc_table: {"idx_pool": "pool_id"},
+        }
+        # uses its own connection rather than fetch/commit, so a denied ALTER doesn't go through
+        # the retry & pool rebuild logic meant for connection failures
+        try:
+            async with self._connection_pool.acquire() as conn:
+                cursor = await conn.cursor()
+                await cursor.execute("SELECT DISTINCT table_name, index_name FROM information_schema.statistics "\
+                                     "WHERE table_schema = DATABASE() AND table_name IN (%s, %s);", (self.char_table, self.acc_table))
+                existing = set(await cursor.fetchall())
+
+                for table, indexes in wanted.items():
+                    for name, columns in indexes.items():
+                        if (table, name) in existing: # mysql has no CREATE INDEX IF NOT EXISTS
+                            continue
+                        print(f" - adding index {name} to {table}")
+                        try: # one at a time, so one failing index doesn't keep out the others
+                            await cursor.execute(f"ALTER TABLE {table} ADD INDEX {name} ({columns});")
+                        except mysql.Error as e: # e.g. no ALTER privilege, the bot still works without them
+                            print(f"Something went wrong when adding index {name}, lookups will be slower:\n{e}")
+                await cursor.close()
+        except mysql.Error as e:
+            print(f"Something went wrong when checking indexes, lookups will be slower:\n{e}")
+
     # connection & err handling
     async def _build_pool(self):
         print(" - building connection pool")
         try:
             self._connection_pool = await mysql.create_pool(minsize=1, maxsize=5, **self.credentials)
             self.stable_pool.set()
-        except mysql.InterfaceError as e:
+        except (mysql.InterfaceError, mysql.OperationalError) as e:
             print(f"Something went wrong when trying to establish a connection to the db:\n{e}")
             return
 
     async def _rebuild_pool(self):
-        print("rebuilding pool")
-        try:
-            await self._close_pool()
-            await self._build_pool(self.credentials)
-            print(f"rebuilt pool at {datetime.now(timezone.utc)} with {self.waiting_executions} waiting executions")
-            self.stable_pool.set()
+        async with self.rebuild_lock: # only one rebuild at a time
+            print("rebuilding pool")
+            attempts = 0
+            while not self.stable_pool.is_set(): # keep trying, everything else is waiting on the pool
+                try:
+                    await self._close_pool()
+                    await self._build_pool()
+                except Exception as e:
+                    print(f"Something went wrong when trying to rebuild:\n{e}")
 
-        except Exception as e:
-            print(f"Something went wrong when trying to rebuild:\n{e}")
-            pass
+                if not self.stable_pool.is_set():
+                    attempts += 1
+                    await asyncio.sleep(min(2**attempts, self.max_backoff))
+
+            print(f"rebuilt pool at {datetime.now(timezone.utc)} with {self.waiting_executions} waiting executions")
 
     async def _close_pool(self):
+        if not hasattr(self, "_connection_pool"): return # never got built
         print(" - closing connection pool")
         self._connection_pool.close()
         await self._connection_pool.wait_closed()
 
-    # periodic reset
+    async def _flush_and_close_pool(self):
+        await self.flush_xp()
+        await self._close_pool()
+
+    # periodic reset & xp flush
     async def _start_scheduler(self):
         print(" - starting periodic reset scheduler")
         self.scheduler = AsyncIOScheduler()
         self.scheduler.start()
 
+        self.scheduler.add_job(
+            self.flush_xp,
+            IntervalTrigger(seconds=self.flush_interval)
+        )
         self.scheduler.add_job(
             self.periodic_reset,
             CronTrigger.from_crontab(
@@ -132,7 +247,9 @@ class xp_system_db_connection(commands.Cog):
 
     async def periodic_reset(self):
         print("Reseting periodic cap")
+        await self.flush_xp() # gains from before the reset count towards the old period
         await self.commit(f"UPDATE {self.char_table} SET roleplay_xp = 0;")
+        self.active_character_cache.clear()
 
 
     # general db operations
@@ -141,7 +258,7 @@ class xp_system_db_connection(commands.Cog):
 
         async def interaction(self, *args, **kwargs):
             if not self.stable_pool.is_set():
-                wait_time_to_prevent_overload = self.waiting_executions * self.stagger_time
+                wait_time_to_prevent_overload = min(self.waiting_executions * self.stagger_time, self.max_stagger)
                 self.waiting_executions += 1
 
                 await self.stable_pool.wait() # wait for connection flag
@@ -154,73 +271,198 @@ class xp_system_db_connection(commands.Cog):
             while retries < self.max_retries:
                 try:
                     return await func(self, *args, **kwargs)
-                except mysql.OperationalError as e:
+                except (mysql.OperationalError, mysql.InterfaceError) as e:
+                    if not _is_connection_error(e): # bad statement, access denied, ... retrying won't help
+                        raise
                     retries += 1
                     if retries >= self.max_retries: # retries fail
-                        if not self.stable_pool.is_set(): # rebuild sequence not yet initiated
-                            self.stable_pool.clear()
+                        if self.stable_pool.is_set(): # rebuild sequence not yet initiated
+                            self.stable_pool.clear() # no await since the check, so only one caller gets here
                             self.crash_time = datetime.now(timezone.utc)
                             print(f"Pool crashed at {self.crash_time} due to the following exception:\n\"{e}\"")
                             await self._rebuild_pool()
                         else: # if it is, wait until rebuilt
-                            self.stable_pool.wait()
+                            await self.stable_pool.wait()
 
                         try: # try again
                             return await func(self, *args, **kwargs)
-                        except Exception as er:
+                        except Exception:
                             print(f"An exception occured after rebuilding pool:")
-                            raise er
+                            raise
                     
-                    await asyncio.sleep(2)
-                except Exception as e:
-                    raise e
+                    await asyncio.sleep(min(2**retries, self.max_backoff)) # back off before retrying
 
         return interaction
 
     @_database_interaction
-    async def fetch(self, statement:str) -> tuple|list[tuple]:
+    async def fetch_one(self, statement:str, params:tuple = None) -> tuple|None:
+        """A function for executing a single SELECT statement and fetching the first row of the result.
+        Values are passed separately in params, and bound to %s placeholders in the statement.
+        Returns a tuple of that row, or None if there are no results."""
+    
+        async with self._connection_pool.acquire() as conn:
+            cursor = await conn.cursor()
+            await cursor.execute(statement, params)
+            result = await cursor.fetchone()
+            await cursor.close()
+
+        return result
+
+    @_database_interaction
+    async def fetch_all(self, statement:str, params:tuple = None) -> list[tuple]:
         """A function for executing a single SELECT statement and fetching the result.
-        If the result is a single row it will return a tuple of that row.
-        If the result is multiple rows, it will return a list containing each result."""
+        Values are passed separately in params, and bound to %s placeholders in the statement.
+        Returns a list containing a tuple for each row, which is empty if there are no results."""
     
         async with self._connection_pool.acquire() as conn:
             cursor = await conn.cursor()
-            await cursor.execute(statement)
+            await cursor.execute(statement, params)
             result = await cursor.fetchall()
             await cursor.close()
 
-        return result[0] if len(result) == 1 else list(result)
+        return list(result)
        
     @_database_interaction
-    async def commit(self, statement:str):
+    async def commit(self, statement:str, params:tuple = ()):
         """A function for executing one or more statements and commiting the resulting changes.
-        For multiple statements, they must be seperated with ';' as per SQL syntax"""
+        For multiple statements, they must be seperated with ';' as per SQL syntax,
+        and are sent to the server together in one round trip.
+        Values are passed separately in params, and bound to the %s placeholders in order."""
+
+        async with self._connection_pool.acquire() as conn:
+            cursor = await conn.cursor()
+            await cursor.execute(statement, tuple(params) if params else None)
+            while await cursor.nextset(): # drain the results, errors in later statements surface here
+                pass
+            await cursor.close()
+            await conn.commit()
+
+    @_database_interaction
+    async def commit_batches(self, batches: list[tuple[str, list]]):
+        """Like commit, but for a list of (statement, params) batches, each sent in its own round trip.
+        All of them run on one connection and are commited together, as a single transaction."""
 
         async with self._connection_pool.acquire() as conn:
             cursor = await conn.cursor()
-            for s in statement.split(";"):
-                if s: await cursor.execute(s)
+            for statement, params in batches:
+                await cursor.execute(statement, tuple(params) if params else None)
+                while await cursor.nextset():
+                    pass
             await cursor.close()
             await conn.commit()
 
+    @_database_interaction
+    async def add_xp(self, character_id: int, amount: int) -> tuple[int, int]:
+        """Adds xp to a character, or removes it for negative amounts, without going below 0.
+        Locks, updates and reads back the row in a single round trip, returning (previous total, new total)."""
+
+        async with self._connection_pool.acquire() as conn:
+            cursor = await conn.cursor()
+            await cursor.execute(f"SELECT total_xp FROM {self.char_table} WHERE character_id = %s FOR UPDATE;"\
+                                 f"UPDATE {self.char_table} SET total_xp = GREATEST(0, CAST(total_xp AS SIGNED) + %s) WHERE character_id = %s;"\
+                                 f"SELECT total_xp FROM {self.char_table} WHERE character_id = %s;",
+                                 (character_id, amount, character_id, character_id))
+            previous = await cursor.fetchone()
+            await cursor.nextset() # the update
+            await cursor.nextset()
+            new = await cursor.fetchone()
+            await cursor.close()
+            await conn.commit()
+
+        if not previous:
+            raise notifyUserException("That character doesn't exist anymore")
+        self.forget_cached_character(character_id)
+        self.top_cache.clear()
+        return previous[0], new[0]
+
+    # buffered xp
+    def queue_xp_gain(self, character_id: int, total_xp: int, roleplay_xp: int, words_cached: int):
+        """Buffers xp gained by a character until the next flush.
+        The xp values are added on top of what's already buffered, words_cached replaces it."""
+        pending = self.pending_xp.setdefault(character_id, {"total_xp": 0, "roleplay_xp": 0, "words_cached": 0})
+        pending["total_xp"] += total_xp
+        pending["roleplay_xp"] += roleplay_xp
+        pending["words_cached"] = words_cached
+
+        if len(self.pending_xp) >= self.flush_max_rows and not self._flush_task:
+            self._flush_task = self.bot.loop.create_task(self.flush_xp())
+            self._flush_task.add_done_callback(self._finish_flush_task)
+
+    def _finish_flush_task(self, task: asyncio.Task):
+        self._flush_task = None
+        if not task.cancelled() and task.exception(): # the gains were put back, the next flush retries them
+            print(f"Flushing buffered xp failed:\n{''.join(traceback.format_exception(task.exception()))}")
+
+    async def flush_xp(self):
+        """Writes all buffered xp gains to the database in a single UPDATE statement."""
+        if not self.pending_xp:
+            return
+        pending, self.pending_xp = self.pending_xp, {}
+        self._flushing_xp.append(pending)
+
+        case = f"CASE character_id {'WHEN %s THEN %s ' * len(pending)}END"
+        params = []
+        for column in ("total_xp", "roleplay_xp", "words_cached"):
+            for c, p in pending.items():
+                params.extend((c, p[column]))
+        params.extend(pending)
+
+        try:
+            await self.commit(f"UPDATE {self.char_table} SET "\
+                              f"total_xp = total_xp + {case}, "\
+                              f"roleplay_xp = roleplay_xp + {case}, "\
+                              f"words_cached = {case} "\
+                              f"WHERE character_id IN ({', '.join(['%s'] * len(pending))});", params)
+        except Exception:
+            # put the gains back so the next flush retries them, newer words_cached values win
+            for c, p in pending.items():
+                if c in self.pending_xp:
+                    self.pending_xp[c]["total_xp"] += p["total_xp"]
+                    self.pending_xp[c]["roleplay_xp"] += p["roleplay_xp"]
+                else:
+                    self.pending_xp[c] = p
+            raise
+        finally: # written or back in pending_xp, either way no longer in flight
+            self._flushing_xp = [b for b in self._flushing_xp if b is not pending] # by identity, batches can compare equal
+
+    def _with_pending_xp(self, character: player_character) -> player_character:
+        """Adds any buffered or in flight, not yet written xp to a character read from the database"""
+        for batch in (*self._flushing_xp, self.pending_xp): # oldest first, so the newest words_cached wins
+            pending = batch.get(character.id)
+            if pending:
+                character.total_xp += pending["total_xp"]
+                character.roleplay_xp += pending["roleplay_xp"]
+                character.words_cached = pending["words_cached"]
+        return character
+
+    # active character cache
+    def forget_cached_character(self, character_id: int):
+        """Drops a character from the active character cache, after it was changed in the database"""
+        for account_id in [a for a, (c, _) in self.active_character_cache.items() if c.id == character_id]:
+            del self.active_character_cache[account_id]
+
     # specific operations
     async def merge_pools(self, pool_a:int, pool_b:int):
-        # merge a into b
+        """Moves every account & character in pool_a into pool_b.
+        The updates are sent together by a single commit, so they apply as one transaction."""
         if pool_a == pool_b:
             raise notifyUserException("Cannot merge the same pool.")
         
-        c = await self.fetch(f"SELECT character_name FROM {self.char_table} WHERE pool_id = {pool_a} OR pool_id = {pool_b}")
-        if type(c) == tuple: c = [c]
-        if len(c) > self.max_characters_per_pool:
+        total, unique_names = await self.fetch_one(f"SELECT COUNT(*), COUNT(DISTINCT character_name) FROM {self.char_table} WHERE pool_id IN (%s, %s)", (pool_a, pool_b))
+        if total > self.max_characters_per_pool:
             raise notifyUserException("Merging these two pools would exceed the character limit")
-        if len(c) != len(set(c)):
+        if total != unique_names:
             raise notifyUserException("There are multiple characters with the same name in the pools you want to merge")
 
-        await self.commit(f"UPDATE {self.acc_table} SET pool_id = {pool_b} WHERE pool_id = {pool_a};"\
-                          f"UPDATE {self.char_table} SET pool_id = {pool_b} WHERE pool_id = {pool_a};")
+        await self.commit(f"UPDATE {self.acc_table} SET pool_id = %s WHERE pool_id = %s;"\
+                          f"UPDATE {self.char_table} SET pool_id = %s WHERE pool_id = %s;",
+                          (pool_b, pool_a, pool_b, pool_a))
+        self.active_character_cache.clear()
+        self.pool_cache.clear()
 
     async def separate_pools(self, acc_a:int, acc_b:int):
-        # sep a from b
+        """Separates acc_a, along with the characters it owns, from the pool it shares with acc_b.
+        The updates are sent together by a single commit, so they apply as one transaction."""
         shared_pool = await self.get_pool_by_account(acc_a)
 
         if acc_a == acc_b or shared_pool != await self.get_pool_by_account(acc_b):
@@ -230,38 +472,130 @@ class xp_system_db_connection(commands.Cog):
             # shift all accounts in the pool other than a into pool_b
             # update all characters in shared pool accordingly
             # separate all characters owned by acc_a into pool_a
-            statement = f"UPDATE {self.acc_table} SET pool_id = {acc_b} WHERE pool_id = {shared_pool} AND account_id != {acc_a};"\
-                        f"UPDATE {self.char_table} SET pool_id = {acc_b} WHERE pool_id = {shared_pool};"\
-                        f"UPDATE {self.char_table} SET pool_id = {acc_a} WHERE owner_id = {acc_a};"
+            statement = f"UPDATE {self.acc_table} SET pool_id = %s WHERE pool_id = %s AND account_id != %s;"\
+                        f"UPDATE {self.char_table} SET pool_id = %s WHERE pool_id = %s;"\
+                        f"UPDATE {self.char_table} SET pool_id = %s WHERE owner_id = %s;"
+            params = (acc_b, shared_pool, acc_a, acc_b, shared_pool, acc_a, acc_a)
         else: # the pool belongs to b, or some other account
             # move acc_a out of shared pool
             # move all characters owned by acc_a into that pool
-            statement = f"UPDATE {self.acc_table} SET pool_id = {acc_a} WHERE account_id = {acc_a};"\
-                        f"UPDATE {self.char_table} SET pool_id = {acc_a} WHERE owner_id = {acc_a};"
-
-        await self.commit(statement)
+            statement = f"UPDATE {self.acc_table} SET pool_id = %s WHERE account_id = %s;"\
+                        f"UPDATE {self.char_table} SET pool_id = %s WHERE owner_id = %s;"
+            params = (acc_a, acc_a, acc_a, acc_a)
+
+        await self.commit(statement, params)
+        self.active_character_cache.clear()
+        self.pool_cache.clear()
+
+    async def get_rank_window(self, character_id: int) -> list[tuple]:
+        """Returns a character's leaderboard row along with the rows directly above and below it,
+        as (rank, character_name, total_xp, owner_id, character_id, total ranked characters)."""
+        ranked = await self.fetch_all(f"WITH ranked AS ("\
+                                  "SELECT ROW_NUMBER() OVER (ORDER BY total_xp DESC, character_id) AS position, "\
+                                  "character_name, total_xp, owner_id, character_id, COUNT(*) OVER () AS total "\
+                                  f"FROM {self.char_table}), "\
+                                  "me AS (SELECT position FROM ranked WHERE character_id = %s) "\
+                                  "SELECT ranked.* FROM ranked, me "\
+                                  "WHERE ranked.position BETWEEN me.position - 1 AND me.position + 1 "\
+                                  "ORDER BY ranked.position;", (character_id,))
+        return ranked
+
+    async def get_top_characters(self, limit: int = 10) -> list[tuple]:
+        """Returns the highest ranked characters as (character_name, total_xp, owner_id).
+        Only reads `limit` rows, using the idx_total_xp index added by _ensure_indexes.
+        Results are cached for top_cache_ttl seconds, roleplay xp shows up once that runs out."""
+        cached = self.top_cache.get(limit)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+
+        top = await self.fetch_all(f"SELECT character_name, total_xp, owner_id FROM {self.char_table} "\
+                                   "ORDER BY total_xp DESC, character_id LIMIT %s;", (limit,))
+        self.top_cache[limit] = (top, time.monotonic() + self.top_cache_ttl)
+        return top
+
+    async def get_pool_ranks(self, account_id: int) -> list[tuple]:
+        """Returns the leaderboard position of every character in an account's pool,
+        as (rank, character_name, total_xp), best ranked first."""
+        pool_id = await self.get_pool_by_account(account_id)
+        ranked = await self.fetch_all(f"WITH ranked AS ("\
+                                  "SELECT ROW_NUMBER() OVER (ORDER BY total_xp DESC, character_id) AS position, "\
+                                  f"character_name, total_xp, pool_id FROM {self.char_table}) "\
+                                  "SELECT position, character_name, total_xp FROM ranked "\
+                                  "WHERE pool_id = %s ORDER BY position;", (pool_id,))
+        return ranked
+
+    def _bulk_insert(self, table: str, columns: tuple[str], rows: list[tuple], chunk_size: int = 5000) -> list[tuple[str, list]]:
+        """Builds multi-row INSERT statements for the given rows, as (statement, params) batches for commit_batches.
+        Rows are split into chunks, so a single statement stays below max_allowed_packet."""
+        values = f"({', '.join(['%s'] * len(columns))})"
+        batches = []
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i+chunk_size]
+            params = []
+            for row in chunk:
+                params.extend(row)
+            batches.append((f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([values] * len(chunk))};", params))
+
+        return batches
+
+    async def bulk_add_pools(self, account_ids: list[int]):
+        """Gives each of the accounts its own pool, in a single transaction"""
+        if account_ids:
+            await self.commit_batches(self._bulk_insert(self.acc_table, ("account_id", "pool_id"), [(a, a) for a in account_ids]))
+            self.pool_cache.update({a: a for a in account_ids})
 
     async def add_pool_for_account(self, account_id: int):
-        await self.commit(f"INSERT INTO {self.acc_table} (account_id, pool_id) VALUES ({account_id}, {account_id})")
+        await self.bulk_add_pools([account_id])
 
     async def get_pool_by_account(self, account_id: int) -> int:
-        pool = await self.fetch(f"SELECT pool_id FROM {self.acc_table} WHERE account_id = {account_id}")
+        if account_id in self.pool_cache:
+            return self.pool_cache[account_id]
+
+        pool = await self.fetch_one(f"SELECT pool_id FROM {self.acc_table} WHERE account_id = %s", (account_id,))
         if pool:
+            self.pool_cache[account_id] = pool[0]
             return pool[0]
         else:
             await self.add_pool_for_account(account_id)
             return account_id
 
+    async def get_pool_ids(self, account_ids: list[int]) -> dict[int, int]:
+        """Returns the pool of each account, looking up the uncached ones in a single query.
+        Accounts without a pool get their own, like in get_pool_by_account."""
+        missing = [a for a in set(account_ids) if a not in self.pool_cache]
+        if missing:
+            rows = await self.fetch_all(f"SELECT account_id, pool_id FROM {self.acc_table} "\
+                                        f"WHERE account_id IN ({', '.join(['%s'] * len(missing))});", missing)
+            self.pool_cache.update(rows)
+            await self.bulk_add_pools([a for a in missing if a not in self.pool_cache])
+
+        return {a: self.pool_cache[a] for a in account_ids}
+
+    async def get_pool_snapshot(self, account_id: int) -> tuple[list[str], list[int]]:
+        """Returns the names of the characters in an account's pool, and the accounts sharing it, in one query"""
+        rows = await self.fetch_all(f"SELECT c.character_name, NULL FROM {self.char_table} c "\
+                                    f"JOIN {self.acc_table} a ON a.pool_id = c.pool_id WHERE a.account_id = %s "\
+                                    "UNION ALL "\
+                                    f"SELECT NULL, b.account_id FROM {self.acc_table} a "\
+                                    f"JOIN {self.acc_table} b ON b.pool_id = a.pool_id WHERE a.account_id = %s "\
+                                    "ORDER BY 1, 2;", (account_id, account_id))
+        if not rows: # an account always shares its own pool, so it doesn't have one yet
+            await self.add_pool_for_account(account_id)
+            return [], [account_id]
+
+        return [name for name, _ in rows if name is not None], [acc for name, acc in rows if name is None]
+
     async def get_available_characters(self, account_id: int) -> list[player_character]:
         pool_id = await self.get_pool_by_account(account_id)
-        characters = await self.fetch(f"SELECT * FROM {self.char_table} WHERE pool_id = {pool_id} ORDER BY character_name;")
-
-        if type(characters) == tuple: # if there's only one, wrap it in a list
-            characters = [characters]
+        characters = await self.fetch_all(f"SELECT * FROM {self.char_table} WHERE pool_id = %s ORDER BY character_name;", (pool_id,))
 
-        return [player_character(c) for c in characters]
+        return [self._with_pending_xp(player_character(c)) for c in characters]
     
     async def get_active_character(self, account_id:int) -> player_character:
+        cached = self.active_character_cache.get(account_id)
+        if cached and time.monotonic() < cached[1]:
+            return cached[0]
+
         characters = await self.get_available_characters(account_id)
         active_char = None
         
@@ -276,103 +610,122 @@ class xp_system_db_connection(commands.Cog):
                     active_char = c
 
         if active_char:
+            self.active_character_cache[account_id] = (active_char, time.monotonic() + self.active_character_ttl)
             return active_char
         else:
             raise notifyUserException("The account doesn't have any active characters")
 
     async def get_character(self, account_id:int, name:str) -> player_character:
         pool_id = await self.get_pool_by_account(account_id)
-        result = await self.fetch(f"SELECT * FROM {self.char_table} WHERE pool_id = {pool_id} AND character_name = '{name}';")
-        if type(result) == tuple:
-            return player_character(result)
-        elif len(result) == 0:
+        result = await self.fetch_one(f"SELECT * FROM {self.char_table} WHERE pool_id = %s AND character_name = %s LIMIT 1;", (pool_id, name))
+        if result:
+            return self._with_pending_xp(player_character(result))
+        else:
             raise notifyUserException("The account doesn't have access to that character")
 
+    async def character_name_exists(self, pool_id: int, name: str) -> bool:
+        return bool(await self.fetch_one(f"SELECT 1 FROM {self.char_table} WHERE pool_id = %s AND character_name = %s LIMIT 1;", (pool_id, name)))
+
     async def switch_active_character(self, account_id: int, name: str):
         pool_id = await self.get_pool_by_account(account_id)
-        char = await self.fetch(f"SELECT character_name FROM {self.char_table} WHERE pool_id = {pool_id} AND character_name = '{name}'")
-        if char:
-            await self.commit(f"UPDATE {self.char_table} SET active_on_account = 0 WHERE active_on_account = {account_id};" \
-                        f"UPDATE {self.char_table} SET active_on_account = {account_id} WHERE pool_id = {pool_id} AND character_name = '{name}'")
+        target = await self.fetch_one(f"SELECT character_id FROM {self.char_table} WHERE pool_id = %s AND character_name = %s LIMIT 1;", (pool_id, name))
+        if target:
+            await self.commit(f"UPDATE {self.char_table} SET active_on_account = 0 WHERE active_on_account = %s;" \
+                        f"UPDATE {self.char_table} SET active_on_account = %s WHERE character_id = %s",
+                        (account_id, account_id, target[0]))
+            self.active_character_cache.pop(account_id, None)
+            self.forget_cached_character(target[0]) # it may have been active on another account sharing the pool
         else:
             raise notifyUserException("The account doesn't have access to that character")
 
-    async def set_properties_of_character(self, character_id: int, **kwargs):
-        changes = {}
+    # property validators, each returns the value to store or raises a notifyUserException
+    def _validate_name(self, value) -> str:
+        n = str(value)
+        if len(n) <=32 and '"' not in n and "'" not in n:
+            return n.lower()
+        raise notifyUserException("The specified name needs to be 32 characters or less, and cannot contain ' or \", or any characters that aren't UTF-8")
 
-        # name - check lenght/if the name is already taken in the pool
-        if "character_name" in kwargs:
-            n = str(kwargs["character_name"])
-            if len(n) <=32 and '"' not in n and "'" not in n:
-                changes["character_name"] = f'\'{str(kwargs["character_name"]).lower()}\''
-            else:
-                raise notifyUserException("The specified name needs to be 32 characters or less, and cannot contain ' or \", or any characters that aren't UTF-8")
-        if "character_color" in kwargs:
-            if kwargs["character_color"].lower() in ("none","null"):
-                changes["character_color"] = "NULL"
-            else:
-                try:
-                    c = kwargs["character_color"].removeprefix("0x")
-                    c = c.removeprefix("#")
-                    int(c, 16)
-                    changes["character_color"] = f'\'{c[-6:]}\''
-                except ValueError:
-                    raise notifyUserException("The specified color is not a valid hex code.")
-        if "character_image" in kwargs:
-            if kwargs["character_image"].lower() in ("none","null"):
-                changes["character_image"] = "NULL"
-            else:
-                try:
-                    url = clean_url(str(kwargs["character_image"]))
-                except:
-                    raise notifyUserException("Invalid url")
-                
-                if validators.url(url):
-                    changes["character_image"] = f'\"{url}\"'
-                else:
-                    raise notifyUserException("Invalid url")
-        if "total_xp" in kwargs:
-            if type(kwargs["total_xp"]) == int and kwargs["total_xp"] >= 0:
-                changes["total_xp"] = kwargs["total_xp"]
-            else:
-                raise notifyUserException(f"Invalid value for total_xp: {kwargs['total_xp']}")
-        if "roleplay_xp" in kwargs:
-            if type(kwargs["roleplay_xp"]) == int and kwargs["roleplay_xp"] >= 0:
-                changes["roleplay_xp"] = kwargs["roleplay_xp"]
-            else:
-                raise notifyUserException(f"Invalid value for roleplay_xp: {kwargs['roleplay_xp']}")
-        if "level" in kwargs:
-            if type(kwargs["level"]) == int and kwargs["level"] >= self.min_level and kwargs["level"] <= self.max_level:
-                changes["level"] = kwargs["level"]
-            else:
-                raise notifyUserException(f"Invalid value for level: {kwargs['level']}")
-        if "words_cached" in kwargs:
-            if type(kwargs["words_cached"]) == int and kwargs["words_cached"] >= 0:
-                changes["words_cached"] = kwargs["words_cached"]
-            else:
-                raise notifyUserException(f"Invalid value for words_cached: {kwargs['words_cached']}")
-        if "level_notification" in kwargs:
-            if type(kwargs["level_notification"]) == int and kwargs["level_notification"] in (0,1):
-                changes["level_notification"] = kwargs["level_notification"]
-            else:
-                raise notifyUserException(f"Invalid value for level_notification: {kwargs['level_notification']}")
+    def _validate_color(self, value) -> str|None:
+        if value.lower() in ("none","null"):
+            return None
+        try:
+            c = value.removeprefix("0x")
+            c = c.removeprefix("#")
+            int(c, 16)
+            return c[-6:]
+        except ValueError:
+            raise notifyUserException("The specified color is not a valid hex code.")
+
+    def _validate_image(self, value) -> str|None:
+        if value.lower() in ("none","null"):
+            return None
+        try:
+            url = clean_url(str(value))
+        except ValueError: # urlparse rejects some malformed urls outright
+            raise notifyUserException("Invalid url")
+
+        if validators.url(url):
+            return url
+        raise notifyUserException("Invalid url")
+
+    def _validate_count(self, value, key) -> int: # xp & word counts
+        if isinstance(value, int) and value >= 0:
+            return value
+        raise notifyUserException(f"Invalid value for {key}: {value}")
+
+    def _validate_level(self, value) -> int:
+        if isinstance(value, int) and self.min_level <= value <= self.max_level:
+            return value
+        raise notifyUserException(f"Invalid value for level: {value}")
+
+    def _validate_notification(self, value) -> int:
+        if isinstance(value, int) and value in (0,1):
+            return value
+        raise notifyUserException(f"Invalid value for level_notification: {value}")
+
+    _property_validators = {
+        "character_name": _validate_name,
+        "character_color": _validate_color,
+        "character_image": _validate_image,
+        "total_xp": lambda self, v: self._validate_count(v, "total_xp"),
+        "roleplay_xp": lambda self, v: self._validate_count(v, "roleplay_xp"),
+        "words_cached": lambda self, v: self._validate_count(v, "words_cached"),
+        "level": _validate_level,
+        "level_notification": _validate_notification,
+        "owner_id": lambda self, v: int(v),
+        "pool_id": lambda self, v: int(v),
+        "active_on_account": lambda self, v: int(v),
+    }
 
-        if "owner_id" in kwargs: changes["owner_id"] = int(kwargs["owner_id"])
-        if "pool_id" in kwargs: changes["pool_id"] = int(kwargs["pool_id"])
-        if "active_on_account" in kwargs: changes["active_on_account"] = int(kwargs["active_on_account"])
+    async def set_properties_of_character(self, character_id: int, **kwargs):
+        """Validates and writes the given properties, unknown properties are ignored.
+        Roleplay xp gains don't go through here, they're buffered by queue_xp_gain."""
+        changes = {}
+        for key, value in kwargs.items():
+            validator = self._property_validators.get(key)
+            if validator:
+                changes[key] = validator(self, value)
 
         if changes:
-            statement = f"UPDATE {self.char_table} SET {', '.join([f'{c[0]} = {c[1]}' for c in changes.items()])} WHERE character_id = {character_id};"
-            await self.commit(statement)
+            statement = f"UPDATE {self.char_table} SET {', '.join([f'{c} = %s' for c in changes])} WHERE character_id = %s;"
+            await self.commit(statement, (*changes.values(), character_id))
+            self.forget_cached_character(character_id)
+            if not self.leaderboard_columns.isdisjoint(changes):
+                self.top_cache.clear()
         else:
             raise notifyUserException("No valid changes given")
 
+    async def delete_character(self, character_id: int):
+        await self.commit(f"DELETE FROM {self.char_table} WHERE character_id = %s;", (character_id,))
+        self.pending_xp.pop(character_id, None) # nothing left to write it to
+        self.forget_cached_character(character_id)
+        self.top_cache.clear()
+
     async def add_character_to_db(self, account_id: int, name: str) -> player_character:
         pool_id = await self.get_pool_by_account(account_id)
 
-        characters = await self.fetch(f"SELECT character_name FROM {self.char_table} WHERE pool_id = {pool_id};")
+        characters = await self.fetch_all(f"SELECT character_name FROM {self.char_table} WHERE pool_id = %s;", (pool_id,))
         if characters:
-            if type(characters) == tuple: characters = [characters] # if there's only one entry
             if len(characters) >= self.max_characters_per_pool:
                 raise notifyUserException("Reached character limit")
             if name.lower() in [c[0] for c in characters]:
@@ -381,12 +734,14 @@ class xp_system_db_connection(commands.Cog):
             raise notifyUserException("The desired name is too long. It needs to be 32 characters long or shorter.")
         if not name: name = "character"
 
-        await self.commit(f"UPDATE {self.char_table} SET active_on_account = 0 WHERE active_on_account = {account_id};" \
-                        f"INSERT INTO {self.char_table}" \
-                        "(character_name, owner_id, pool_id, active_on_account)" \
-                        "VALUES"\
-                        f"('{name.lower()}', {account_id}, {pool_id}, {account_id});")
-        return player_character(await self.fetch(f"SELECT * FROM {self.char_table} WHERE active_on_account = {account_id};"))
+        [(insert, params)] = self._bulk_insert(self.char_table,
+                                               ("character_name", "owner_id", "pool_id", "active_on_account"),
+                                               [(name.lower(), account_id, pool_id, account_id)]) # a single row, so a single batch
+        await self.commit(f"UPDATE {self.char_table} SET active_on_account = 0 WHERE active_on_account = %s;" + insert,
+                          (account_id, *params))
+        self.active_character_cache.pop(account_id, None)
+        self.top_cache.clear()
+        return player_character(await self.fetch_one(f"SELECT * FROM {self.char_table} WHERE active_on_account = %s;", (account_id,)))
 
 class xp_system(commands.Cog):
     def __init__(self, bot:discord.bot, configuration):
@@ -396,9 +751,10 @@ class xp_system(commands.Cog):
         self.debug: bool = configuration["debug"]
         self.notification_channel_id = configuration["notification_channel"]
         self.confirmation_timeout: float = 5
+        self._bg_tasks: set[asyncio.Task] = set() # keeps fire & forget tasks alive until they finish
 
         # permissions
-        self.default_perms: list = configuration["permissions"]["default"]
+        self.default_perms: frozenset = frozenset(configuration["permissions"]["default"])
         self.role_permissions = {}
         base_perms = set(configuration["permissions"]["basic_permissions"])
         for role, perms in configuration["permissions"]["roles"].items():
@@ -411,51 +767,62 @@ class xp_system(commands.Cog):
 
                 unresolved_perms = perms.difference(base_perms)
 
-            self.role_permissions[role] = list(perms) # save the corresponding base perms
+            self.role_permissions[role] = frozenset(perms) # save the corresponding base perms
 
         # xp system config
-        self.rp_categories: list = configuration["rp_categories"]
+        self.rp_categories: frozenset = frozenset(configuration["rp_categories"])
+        prefix = self.bot.command_prefix
+        self.prefixes: tuple = tuple(prefix) if isinstance(prefix, (list, tuple)) else (prefix,)
         self.level_req: dict = configuration["level_req"]
         self.xp_rate: int|dict = 1 if not "xp_rate" in configuration else configuration["xp_rate"]
         self.periodic_cap: None|int|dict = None if not "periodic_cap" in configuration else configuration["periodic_cap"]["value"]
 
     # cog functionality
     async def cog_check(self, ctx: commands.Context) -> bool:
-        try:
-            required_perms = ctx.command.extras["required_permissions"]
-            if type(required_perms) not in (list, tuple):
-                required_perms = [required_perms]
-            
-            if not required_perms:
-                return True
-        except:
+        required_perms = ctx.command.extras.get("required_permissions")
+        if not required_perms:
             return True # no perms attached to command
-        
-        permissions = self.default_perms # get permissions
-        for r in [r.id for r in ctx.author.roles]:
-            if r in self.role_permissions:
-                permissions.extend(self.role_permissions[r])
-        
-        required_perms = set(required_perms)
-        permissions = set(permissions)
+        if type(required_perms) not in (list, tuple):
+            required_perms = [required_perms]
 
-        if required_perms.difference(permissions):
-            return False
-        else:
-            return True
+        return self._has_permissions(ctx, required_perms)
+
+    def _has_permissions(self, ctx: commands.Context, required_perms) -> bool:
+        permissions = set(self.default_perms) # get permissions, without touching the defaults
+        for r in ctx.author.roles:
+            permissions |= self.role_permissions.get(r.id, frozenset())
+
+        return permissions.issuperset(required_perms)
+
+    def _require_extra_permissions(self, ctx: commands.Context, *extra_perms: str):
+        """For commands that need more permissions depending on their arguments, like acting on other members"""
+        required_perms = [*ctx.command.extras.get("required_permissions", ()), *extra_perms] # a copy, the extras are shared between invocations
+        if not self._has_permissions(ctx, required_perms):
+            raise missingPermissionsException(required_perms)
 
-    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
-        emb = discord.Embed(color=0x800000)
+    async def cog_before_invoke(self, ctx: commands.Context):
+        await self.db.flush_xp() # commands read & write xp directly, so write out buffered gains first
+
+    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError, *,
+                                _Embed=discord.Embed, _descriptions=command_error_descriptions,
+                                _format_exception=traceback.format_exception): # globals bound as locals
+        emb = _Embed(color=0x800000)
+        error_type = type(error)
 
         if type(error.__cause__) == notifyUserException:
             emb.description = str(error.__cause__)
-        elif type(error) == commands.CheckFailure:
-            emb.description = f"You're missing permissions to use that command.\nYou need the following permissions: `{', '.join(ctx.command.extras['required_permissions'])}`"
-        elif isinstance(error, commands.UserInputError):
-            emb.description = "User input error"
         else:
-            emb.title = type(error).__name__
-            emb.description = f"{str(error)}" if not self.debug else f"```\n{traceback.format_exc()}```"
+            for cls in error_type.__mro__:
+                if cls in _descriptions:
+                    emb.description = _descriptions[cls](ctx, error)
+                    break
+            else:
+                emb.title = error_type.__name__
+                if self.debug: # only format tracebacks when they're going to be shown
+                    tb_lines = _format_exception(error_type, error, error.__traceback__)
+                    emb.description = "```\n" + "".join(tb_lines) + "```"
+                else:
+                    emb.description = str(error)
         
         await ctx.send(embed=emb)
 
@@ -477,17 +844,16 @@ class xp_system(commands.Cog):
         for arg in args:
             try:
                 arg_member = await commands.MemberConverter().convert(ctx, arg)
-                if member:
-                    raise notifyUserException("Expected only one member, got multiple.")
-                else:
-                    member = arg_member
-            except commands.ArgumentParsingError as e:
-                raise e
-            except Exception as e:
+            except commands.MemberNotFound: # not a member, so it names a character
                 if character:
                     raise notifyUserException("Expected only one character, got multiple.")
                 else:
                     character = arg
+            else:
+                if member:
+                    raise notifyUserException("Expected only one member, got multiple.")
+                else:
+                    member = arg_member
 
         if not member:
             member = ctx.author
@@ -498,11 +864,15 @@ class xp_system(commands.Cog):
 
         return (member, character)
 
+    def _character_embed(self, character: player_character, member: discord.Member, **kwargs) -> discord.Embed:
+        """An embed in the character's color, falling back to the member's"""
+        return discord.Embed(color = character.color or member.color, **kwargs)
+
     def _get_xp_until_lvl_up(self, character: player_character) -> int | None:
-        try:
-            return self.level_req[character.level+1] - character.total_xp
-        except:
+        """xp left until the next level, 0 or less once the character can level up, None at max level"""
+        if character.level >= self.db.max_level:
             return None
+        return self.level_req[character.level+1] - character.total_xp
 
     def _get_max_cache(self, character: player_character) -> int:
         return self.xp_rate if type(self.xp_rate) == int else self.xp_rate[character.level]
@@ -535,39 +905,69 @@ class xp_system(commands.Cog):
                 await ctx.send("Cancelling.")
             return False
 
-    async def check_and_notify_level_up(self, character: player_character):
+    def _run_in_background(self, coro) -> asyncio.Task:
+        """Runs a coroutine without waiting for it, printing any exception it ends with"""
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._finish_background_task)
+        return task
+
+    def _finish_background_task(self, task: asyncio.Task):
+        self._bg_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print(f"A background task failed:\n{''.join(traceback.format_exception(task.exception()))}")
+
+    def _level_up_pending(self, character: player_character) -> bool:
         xp_til_level = self._get_xp_until_lvl_up(character)
-        if xp_til_level and xp_til_level <= 0 and character.level_notification:
-            await self.db.set_properties_of_character(character.id, level_notification = 0)
-            notification_channel = self.bot.get_channel(self.notification_channel_id)
-            await notification_channel.send(f"> <@{character.active_on_account if character.active_on_account else character.owner_id}>\nYou have enough experience to level up to lvl **{character.level+1}**! :sparkles:")
+        return xp_til_level is not None and xp_til_level <= 0 and bool(character.level_notification)
+
+    async def _notify_level_up(self, character: player_character):
+        await self.db.set_properties_of_character(character.id, level_notification = 0)
+        mention = character.active_on_account or character.owner_id # whoever is playing it, else the owner
+        notification_channel = self.bot.get_channel(self.notification_channel_id)
+        await notification_channel.send(f"> <@{mention}>\nYou have enough experience to level up to lvl **{character.level+1}**! :sparkles:")
+
+    async def check_and_notify_level_up(self, character: player_character):
+        if self._level_up_pending(character):
+            character.level_notification = 0 # mark it before awaiting, so the cached character isn't notified twice
+            await self._notify_level_up(character)
 
     # discord functionality
     # listeners
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if message.author.bot or (message.channel.category.id not in self.rp_categories) or message.content.startswith(self.bot.command_prefix):
+        author = message.author
+        if author.bot:
+            return
+        category = getattr(message.channel, "category", None) # DMs & some threads don't have one
+        if category is None or category.id not in self.rp_categories:
+            return
+        content = message.content
+        if content.startswith(self.prefixes):
             return
 
         try:
-            character = await self.db.get_active_character(message.author.id)
-            gained_xp, overflow = self._proccess_msg_for_rp(character, message.content)
+            character = await self.db.get_active_character(author.id)
+            gained_xp, overflow = self._proccess_msg_for_rp(character, content)
             
             cap = self._get_rp_cap(character)
             if cap:
                 gained_xp = min(gained_xp, cap - character.roleplay_xp)
                 character.roleplay_xp = character.roleplay_xp + gained_xp           
             character.total_xp += gained_xp
+            character.words_cached = overflow
 
-            if gained_xp or overflow:
-                await self.db.set_properties_of_character(
+            if gained_xp or overflow: # written on the next flush
+                self.db.queue_xp_gain(
                     character.id,
-                    total_xp = character.total_xp,
-                    roleplay_xp = character.roleplay_xp,
+                    total_xp = gained_xp,
+                    roleplay_xp = gained_xp if cap else 0,
                     words_cached = overflow
                 )
             
-            await self.check_and_notify_level_up(character)
+            if self._level_up_pending(character): # don't hold up message handling for the db write & send
+                character.level_notification = 0
+                self._run_in_background(self._notify_level_up(character))
 
         except notifyUserException: # no active character
             pass
@@ -579,10 +979,9 @@ class xp_system(commands.Cog):
     async def stats(self, ctx: commands.Context, *args):
         member, character = await self._get_member_and_char_from_args(ctx, args)
         
-        emb = discord.Embed()
+        emb = self._character_embed(character, member)
 
         emb.title = f"{character.name.capitalize()}'s stats"
-        emb.color = character.color if character.color else member.color
         emb.set_thumbnail(url=character.image_url if character.image_url else member.display_avatar.url)
 
         emb.description  = f"**Level:** `{character.level}` {':crown:' if character.level >= self.db.max_level else ''}\n" \
@@ -595,19 +994,22 @@ class xp_system(commands.Cog):
         emb.description += f"**Roleplay xp this period:** `{character.roleplay_xp}/{roleplay_cap}`\n" if roleplay_cap else ""
 
         # rank
-        ranked = await self.db.fetch(f"SELECT character_name, total_xp, owner_id, character_id FROM {self.db.char_table} ORDER BY total_xp DESC;")
-        if type(ranked) == tuple: ranked = [ranked]
-        rank = [r[3] for r in ranked].index(character.id) + 1
-        rank_above = "" if rank == 1 else f"> {rank-1}. {ranked[rank-2][0].capitalize()} - {ranked[rank-2][1]} xp (<@{ranked[rank-2][2]}>)\n"
-        rank_text = f"> {rank}. **{character.name.capitalize()} - {character.total_xp} xp** (<@{member.id}>)"
-        rank_below = "" if rank == len(ranked) else f"\n> {rank+1}. {ranked[rank][0].capitalize()} - {ranked[rank][1]} xp (<@{ranked[rank][2]}>)"
-        emb.add_field(name = f"Rank {rank}/{len(ranked)}",
+        rank_window = await self.db.get_rank_window(character.id)
+        if not rank_window: # deleted since it was looked up
+            raise notifyUserException("That character doesn't exist anymore")
+        rank_lines = []
+        for position, name, total_xp, owner_id, character_id, total in rank_window:
+            if character_id == character.id:
+                rank = position
+                rank_lines.append(f"> {position}. **{character.name.capitalize()} - {character.total_xp} xp** (<@{member.id}>)")
+            else:
+                rank_lines.append(f"> {position}. {name.capitalize()} - {total_xp} xp (<@{owner_id}>)")
+        emb.add_field(name = f"Rank {rank}/{total}",
                       inline = False,
-                      value = rank_above+rank_text+rank_below)
+                      value = "\n".join(rank_lines))
         
         # list of accounts the character is available to
-        accs = await self.db.fetch(f"SELECT account_id FROM {self.db.acc_table} WHERE pool_id = {character.pool_id};")
-        if type(accs) == tuple: accs = [accs]
+        accs = await self.db.fetch_all(f"SELECT account_id FROM {self.db.acc_table} WHERE pool_id = %s;", (character.pool_id,))
         emb.add_field(name=f" ",
                       inline = False,
                       value=f"This character is available to: {', '.join([f'<@{a[0]}>' for a in accs])}\n"\
@@ -620,22 +1022,18 @@ class xp_system(commands.Cog):
             extras={"required_permissions":[]}
     )
     async def top(self, ctx: commands.Context):
-        ranked = await self.db.fetch(f"SELECT character_name, total_xp, owner_id FROM {self.db.char_table} ORDER BY total_xp DESC;")
-        if type(ranked) == tuple: ranked = [ranked]
-        
+        ranked = await self.db.get_top_characters(10)
+
         emb = discord.Embed(title = "Top 10 characters by xp",
                             color = ctx.author.color)
+        emb.set_footer(text = f"The top 10 can be up to {int(self.db.top_cache_ttl)}s behind your ranks")
         emb.set_thumbnail(url = "https://images-ext-1.discordapp.net/external/mGTL2XzYxMsQa3yZDqwbLaAWUjuqjDhZjhKbn_eX9Gw/https/images.emojiterra.com/twitter/v14.0/512px/1f3c6.png?format=webp&quality=lossless&width=412&height=412")
 
-        top_ten = [f"**{r+1}.** {ranked[r][0].capitalize()} - {ranked[r][1]} xp (<@{ranked[r][2]}>)" for r in range(min(len(ranked), 10))]
-
-        emb.description = "\n".join(top_ten)
+        emb.description = "\n".join(f"**{position}.** {name.capitalize()} - {total_xp} xp (<@{owner_id}>)"
+                                    for position, (name, total_xp, owner_id) in enumerate(ranked, 1))
 
-        characters = await self.db.get_available_characters(ctx.author.id)
-        characters = [f"**{ranked.index((c.name, c.total_xp, c.owner_id))+1}.** {c.name.capitalize()} - {c.total_xp} xp" for c in characters]
-        characters.sort(key=lambda s: int(s.split("**")[1][:-1]))
-
-        emb.add_field(name= "Your ranks:", value="\n".join(characters))
+        pool_ranks = await self.db.get_pool_ranks(ctx.author.id) # already ordered by rank
+        emb.add_field(name= "Your ranks:", value="\n".join(f"**{position}.** {name.capitalize()} - {total_xp} xp" for position, name, total_xp in pool_ranks))
 
         await ctx.send(embed=emb)
 
@@ -646,9 +1044,9 @@ class xp_system(commands.Cog):
         character = await self.db.get_active_character(ctx.author.id)
         xp_remaining = self._get_xp_until_lvl_up(character)
 
-        emb = discord.Embed(color = character.color if character.color else ctx.author.color)
+        emb = self._character_embed(character, ctx.author)
 
-        if not xp_remaining: # max lvl
+        if xp_remaining is None: # max lvl
             emb.title = "Already at max level"
             emb.description = "You cannot level up, because you are already at the maximum possible level. Here's some cake :birthday:"
         elif xp_remaining <= 0: # enough to lvl
@@ -660,7 +1058,7 @@ class xp_system(commands.Cog):
             emb.description = "Congrats!" if character.level == self.db.max_level else f"{self._get_xp_until_lvl_up(character)} xp remaining until level {character.level+1}!"
         else: # not enough to lvl
             emb.title = f"Cannot level up"
-            emb.description = f"You don't have enough xp to level up yet\n({self._get_xp_until_lvl_up(character)} xp remaining)"
+            emb.description = f"You don't have enough xp to level up yet\n({xp_remaining} xp remaining)"
 
         await ctx.send(embed=emb)
     
@@ -671,18 +1069,15 @@ class xp_system(commands.Cog):
     async def _add(self, ctx: commands.Context, amount: int, *args):
         member, character = await self._get_member_and_char_from_args(ctx, args)
 
-        prev_total = character.total_xp
-        character.total_xp = character.total_xp + amount if character.total_xp + amount > 0 else 0
-
-        await self.db.set_properties_of_character(character.id, total_xp=character.total_xp)
+        prev_total, character.total_xp = await self.db.add_xp(character.id, amount)
 
-        await self.check_and_notify_level_up(character)
-
-        emb = discord.Embed(title = "Modifying xp",
-                            color = character.color if character.color else member.color,
-                            description = f"{'Added' if amount >= 0 else 'Removed'} {abs(character.total_xp - prev_total)} xp {'to' if amount >= 0 else 'from'} {character.name.capitalize()} (<@{member.id}>)\n({prev_total} -> {character.total_xp})")
+        emb = self._character_embed(character, member,
+                                    title = "Modifying xp",
+                                    description = f"{'Added' if amount >= 0 else 'Removed'} {abs(character.total_xp - prev_total)} xp {'to' if amount >= 0 else 'from'} {character.name.capitalize()} (<@{member.id}>)\n({prev_total} -> {character.total_xp})")
         await ctx.send(embed=emb)
 
+        self._run_in_background(self.check_and_notify_level_up(character)) # the reply doesn't need to wait for it
+
     # character management
     @commands.group(
             invoke_without_command=True
@@ -709,8 +1104,7 @@ class xp_system(commands.Cog):
         if not member:
             member = ctx.author
         elif member != ctx.author:
-            ctx.command.extras["required_permissions"].append("manage_characters_others")
-            if not await self.cog_check(ctx): raise commands.CheckFailure()
+            self._require_extra_permissions(ctx, "manage_characters_others")
             
         await self.db.add_character_to_db(member.id, name.lower())
         await ctx.send(f"Added character '{name.capitalize()}' and set it as active on {'your account' if member == ctx.author else member.mention}")
@@ -719,29 +1113,23 @@ class xp_system(commands.Cog):
             extras={"required_permissions":["manage_characters_self"]}
     )
     async def edit(self, ctx: commands.Context, *args):
-        characters = await self.db.get_available_characters(ctx.author.id)
         character = await self.db.get_active_character(ctx.author.id)
 
-        name, color, url = None, None, None
         changes = {}
 
         if len(args) > 3:
             raise notifyUserException("Too many arguments")
         
         for arg in args:
-            if arg.startswith("-n=") or arg.startswith("-name="):
-                name = arg[3:] if arg.startswith("-n=") else arg[6:]
-                for c in characters:
-                    if name == c.name: raise notifyUserException("You already have a character with that name")
-            if arg.startswith("-c=") or arg.startswith("-color="):
-                color = arg[3:] if arg.startswith("-c=") else arg[7:]
-            if arg.startswith("-i=") or arg.startswith("-image="):
-                url = arg[3:] if arg.startswith("-i=") else arg[7:]
-
-        if name: changes["character_name"] = name.lower()
-
-        if color: changes["character_color"] = color
-        if url: changes["character_image"] = url
+            flag, _, value = arg.partition("=")
+            prop = character_edit_flags.get(flag)
+            if not prop:
+                raise notifyUserException(f"Unknown option `{flag}`, expected one of: {', '.join(character_edit_flags)}")
+            if value:
+                changes[prop] = value.lower() if prop == "character_name" else value
+
+        if "character_name" in changes and await self.db.character_name_exists(character.pool_id, changes["character_name"]):
+            raise notifyUserException("You already have a character with that name")
         
         await self.db.set_properties_of_character(character.id,
                                                 **changes)
@@ -754,11 +1142,10 @@ class xp_system(commands.Cog):
     async def delete(self, ctx: commands.Context, *args):
         member, character = await self._get_member_and_char_from_args(ctx, args)
         if member != ctx.author:
-            ctx.command.extras["required_permissions"].append("manage_characters_others")
-            if not await self.cog_check(ctx): raise commands.CheckFailure()
+            self._require_extra_permissions(ctx, "manage_characters_others")
 
         if await self.ask_confirmation(ctx, f"You are about to delete '{character.name.capitalize()}'"):
-            await self.db.commit(f"DELETE FROM {self.db.char_table} WHERE character_id = {character.id};")
+            await self.db.delete_character(character.id)
             await ctx.send(f"Deleted '{character.name.capitalize()}'")
 
     @char.command(
@@ -791,15 +1178,11 @@ class xp_system(commands.Cog):
         elif member.bot:
             raise notifyUserException("This is a bot user and as such does not have any characters")
         
-        characters = await self.db.get_available_characters(member.id)
-        pool_id = await self.db.get_pool_by_account(member.id)
-        
-        members = await self.db.fetch(f"SELECT account_id FROM {self.db.acc_table} WHERE pool_id = {pool_id}")
-        if type(members) == tuple: members = [members]
+        characters, members = await self.db.get_pool_snapshot(member.id)
 
         whose_pool_str = 'your' if member == ctx.author else member.display_name+"'s"
-        await ctx.send(f"Characters in {whose_pool_str} pool:\n{', '.join([c.name.capitalize() for c in characters])}\n\n" \
-                       f"Accounts sharing {whose_pool_str} pool:\n{', '.join([f'<@{m[0]}>' for m in members])}",
+        await ctx.send(f"Characters in {whose_pool_str} pool:\n{', '.join(map(str.capitalize, characters))}\n\n" \
+                       f"Accounts sharing {whose_pool_str} pool:\n{', '.join(f'<@{m}>' for m in members)}",
                        allowed_mentions=discord.AllowedMentions.none())
 
     @pool.command(
@@ -808,10 +1191,9 @@ class xp_system(commands.Cog):
     async def merge(self, ctx: commands.Context, m1:discord.Member, m2:discord.Member = None):
         if m1.bot or (m2 and m2.bot):
             raise notifyUserException("Cannot merge pools with a bot")
-        if m2:
-            a, b = await self.db.get_pool_by_account(m1.id), await self.db.get_pool_by_account(m2.id)
-        else:
-            a, b = await self.db.get_pool_by_account(ctx.author.id), await self.db.get_pool_by_account(m1.id)
+        id_a, id_b = (m1.id, m2.id) if m2 else (ctx.author.id, m1.id)
+        pools = await self.db.get_pool_ids([id_a, id_b])
+        a, b = pools[id_a], pools[id_b]
         
         if await self.ask_confirmation(ctx, f"You are about to merge <@{a}>'s and <@{b}>'s pools"):
             await self.db.merge_pools(a, b)
@@ -830,8 +1212,7 @@ class xp_system(commands.Cog):
             a, b = ctx.author.id, m1.id
         
         if a != ctx.author.id or b != ctx.author.id:
-            ctx.command.extras["required_permissions"].append("manage_pools_others")
-            if not await self.cog_check(ctx): raise commands.CheckFailure()
+            self._require_extra_permissions(ctx, "manage_pools_others")
 
         if await self.ask_confirmation(ctx, f"You are about to seperate <@{a}>'s characters from <@{b}>'s pool"):
             await self.db.separate_pools(a, b)
@@ -862,5 +1243,5 @@ class xp_system(commands.Cog):
             extras={"required_permissions":["debug"]}
     )
     async def toggle(self, ctx: commands.Context):
-        self.debug = False if self.debug else True
+        self.debug = not self.debug
         await ctx.send(f"Set debug mode to {self.debug}")